@@ -19,26 +19,131 @@
 import psutil
 import argparse
 import time
+import gc
+import io
+import math
 import os
+import queue
+import sys
+import threading
 from datetime import datetime
-import csv
+from operator import itemgetter
+
+
+# Open file descriptors of the control files. The controller rewrites the control file in place
+# (`echo 1 > file`), so the descriptor stays valid and can be re-read with a single pread.
+_control_fds = {}
 
 
 def read_control(control_file):
-    """Read the control file and return its integer content (1 or 0)."""
-    try:
-        with open(control_file, "r") as f:
-            return int(f.read().strip())
-    except (FileNotFoundError, ValueError):
-        return 0
+    """Read the control file and return 1 if it contains a 1, and 0 otherwise."""
+    fd = _control_fds.get(control_file)
+    if fd is None:
+        try:
+            fd = os.open(control_file, os.O_RDONLY)
+        except FileNotFoundError:
+            return 0
+        _control_fds[control_file] = fd
+    return 1 if os.pread(fd, 8, 0).strip() == b"1" else 0
+
+
+def read_cpu_times(fd):
+    """Read the accumulated busy and total time (in clock ticks) of each CPU from /proc/stat."""
+    data = os.pread(fd, 1 << 16, 0)
+    busy, total = [], []
+    # the per-CPU lines follow the aggregated "cpu " line and end where the "intr" line begins
+    for line in data[data.index(b"\n") + 1 : data.index(b"\nintr")].split(b"\n"):
+        # user nice system idle iowait irq softirq steal (guest time is already part of user)
+        times = [int(x) for x in line.split()[1:9]]
+        cpu_total = sum(times)
+        busy.append(cpu_total - times[3] - times[4])
+        total.append(cpu_total)
+    return busy, total
+
+
+def sample_cpu_percent():
+    """Yield the utilization (in percent) of each CPU since the previous sample. The first sample
+    only initializes the counters and reports 0 for all CPUs (like psutil.cpu_percent)."""
+    fd = os.open("/proc/stat", os.O_RDONLY)
+    last_busy, last_total = read_cpu_times(fd)
+    yield [0.0] * len(last_total)
+    while True:
+        busy, total = read_cpu_times(fd)
+        yield [
+            100.0 * max(b - lb, 0) / (t - lt) if t > lt else 0.0
+            for b, lb, t, lt in zip(busy, last_busy, total, last_total)
+        ]
+        last_busy, last_total = busy, total
+
+
+def read_process_cpu_time(fd):
+    """Read the accumulated user and system time (in clock ticks) of a process from /proc/<pid>/stat."""
+    data = os.pread(fd, 1024, 0)
+    # the process name may contain spaces, so only split the fields after its closing parenthesis
+    fields = data[data.rindex(b")") + 2 :].split()
+    return int(fields[11]) + int(fields[12])
+
+
+def sample_process_cpu_percent(pid):
+    """Yield the CPU utilization (in percent of a single CPU, like psutil's Process.cpu_percent) of
+    the process pid since the previous sample. The first sample only initializes the counters."""
+    fd = os.open(f"/proc/{pid}/stat", os.O_RDONLY)
+    ticks_per_second = os.sysconf("SC_CLK_TCK")
+    last_ticks, last_time = read_process_cpu_time(fd), time.monotonic()
+    yield 0.0
+    while True:
+        ticks, now = read_process_cpu_time(fd), time.monotonic()
+        yield 100.0 * (ticks - last_ticks) / ticks_per_second / (now - last_time) if now > last_time else 0.0
+        last_ticks, last_time = ticks, now
+
+
+def open_log(output_file=None):
+    """Open the destination of the CSV log. Rows are streamed to output_file as they are collected.
+    Rows for stdout are kept in memory until close_log is called, because the controller only
+    drains the pipe once the monitoring has stopped, and a full pipe would stall the sampling."""
+    if output_file:
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        return open(output_file, mode="w", newline="", buffering=1 << 16)
+    return io.StringIO()
+
+
+def close_log(file):
+    """Close the CSV log opened with open_log, writing the buffered rows to stdout if needed."""
+    if isinstance(file, io.StringIO):
+        sys.stdout.write(file.getvalue())
+        sys.stdout.flush()
+    file.close()
+
+
+def wait_for_next_sample(last_sample, interval):
+    """Sleep until the sample after the one due at last_sample (in time.monotonic) is due, and return
+    when that is. Samples are due every interval seconds, so the time spent sampling does not add up.
+    If the last sample took longer than the interval, the missed samples are skipped, and we still
+    sleep at least as long as the last sample took, so the monitor never keeps a whole CPU busy."""
+    now = time.monotonic()
+    next_sample = last_sample + interval
+    if next_sample <= now:
+        # we fell behind, don't try to catch up with a burst of samples
+        next_sample += math.ceil((2 * now - last_sample - next_sample) / interval) * interval
+    time.sleep(next_sample - now)
+    return next_sample
+
+
+def csv_field(value):
+    """Format a process attribute as CSV field. Attributes that psutil could not access (None) are
+    left empty, floats are written with six decimals (memory_percent of small processes is well below
+    0.01), and commas (e.g., in the list of open files) are replaced by semicolons."""
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return "%.6f" % value
+    return str(value).replace(",", ";")
 
 
 def monitor_all_processes(
     interval, control_file, router_id, router_name="", output_file=None
 ):
     """Monitor all processes. Data collection continues until control_file contains something else than a 1."""
-    data_log = []
-
     # wait before starting the measurements
     while read_control(control_file) != 1:
         time.sleep(interval)
@@ -55,61 +160,76 @@ def monitor_all_processes(
         "open_files",
     ]
     headers = ["rid", "router_name", "timestamp"] + attrs
+    # fetches all attributes from proc.info as a tuple (in the order of attrs) in a single call
+    get_attrs = itemgetter(*attrs)
+
+    file = open_log(output_file)
+    snapshots = queue.SimpleQueue()
 
-    cont = True
-    while cont:
-        for proc in psutil.process_iter(attrs):
-            timestamp = datetime.utcnow().timestamp()
-            row = (router_id, router_name, timestamp) + tuple(
-                proc.info[attr] for attr in attrs
+    # rid, router_name, timestamp and pid are always present and formatted according to their type,
+    # the other attributes may be missing and are passed through csv_field
+    row_format = "%d,%s,%.6f,%d" + ",%s" * (len(headers) - 4) + "\n"
+
+    def write_snapshots():
+        # format and write the snapshots in the background, so the sampling is not delayed by it
+        file.write(",".join(headers) + "\n")
+        for snapshot in iter(snapshots.get, None):
+            file.writelines(
+                [row_format % (row[:4] + tuple(map(csv_field, row[4:]))) for row in snapshot]
             )
-            data_log.append(row)
 
-            time.sleep(interval)
-            cont = read_control(control_file) == 1
-            if not cont:
-                break
+    writer_thread = threading.Thread(target=write_snapshots)
+    writer_thread.start()
 
-    if output_file:
-        # Write the collected data to a CSV file
-        os.makedirs(os.path.dirname(output_file), exist_ok=True)
-        with open(output_file, mode="w", newline="") as file:
-            writer = csv.writer(file)
-            writer.writerow(headers)
-            for entry in data_log:
-                writer.writerow(entry)
-    else:
-        print(",".join(headers))
-        for entry in data_log:
-            print(",".join([str(x) for x in entry]))
+    # Every snapshot allocates thousands of short-lived objects, each allocation counting towards the
+    # next garbage collection. Move everything allocated so far into the permanent generation, so
+    # that these collections don't have to scan it over and over again. The collector itself stays
+    # enabled, as psutil may create reference cycles (e.g., when handling AccessDenied).
+    gc.freeze()
+
+    try:
+        cont = True
+        next_sample = time.monotonic()
+        while cont:
+            # take a single snapshot of all processes, sharing one timestamp
+            timestamp = time.time()
+            snapshots.put(
+                [
+                    (router_id, router_name, timestamp) + get_attrs(proc.info)
+                    for proc in psutil.process_iter(attrs)
+                ]
+            )
+
+            next_sample = wait_for_next_sample(next_sample, interval)
+            cont = read_control(control_file) == 1
+    finally:
+        # stop the writer once it has written all remaining snapshots, also if the sampling failed
+        # (e.g., when interrupted), as the writer thread would otherwise wait forever
+        snapshots.put(None)
+        writer_thread.join()
+        close_log(file)
+        gc.unfreeze()
 
 
 def monitor_bgp_cpu(
     interval, control_file, router_id, router_name="", output_file=None
 ):
     """Monitor system and the processes relevant for BGP workloads for CPU usage and log results to a file. Data collection continues until control_file contains something else than a 1."""
-    data_log = []
-
-    # find the BGP process
-    for bgp_process in psutil.process_iter():
-        if bgp_process.name() == "bgp":
-            break
+    # find the bgp, ipfib and urib processes in a single pass over all processes
+    processes = {"bgp": None, "ipfib": None, "urib": None}
+    for proc in psutil.process_iter(["name"]):
+        name = proc.info["name"]
+        if name in processes and processes[name] is None:
+            processes[name] = proc
+            if all(processes.values()):
+                break
+    bgp_process, ipfib_process, urib_process = processes["bgp"], processes["ipfib"], processes["urib"]
     if not bgp_process:
         print("BGP process not found.")
         return
-
-    # find the ipfib process
-    for ipfib_process in psutil.process_iter():
-        if ipfib_process.name() == "ipfib":
-            break
     if not ipfib_process:
         print("'ipfib' process not found.")
         return
-
-    # find the urib process
-    for urib_process in psutil.process_iter():
-        if urib_process.name() == "urib":
-            break
     if not urib_process:
         print("'urib' process not found.")
         return
@@ -119,55 +239,82 @@ def monitor_bgp_cpu(
         time.sleep(interval)
 
     # reset counters
-    last_cpu = psutil.cpu_percent(percpu=True)
-    last_bgp_cpu = bgp_process.cpu_percent()
-    last_ipfib_cpu = ipfib_process.cpu_percent()
-    last_urib_cpu = urib_process.cpu_percent()
+    cpu_sampler = sample_cpu_percent()
+    last_cpu = next(cpu_sampler)
+    bgp_sampler = sample_process_cpu_percent(bgp_process.pid)
+    ipfib_sampler = sample_process_cpu_percent(ipfib_process.pid)
+    urib_sampler = sample_process_cpu_percent(urib_process.pid)
+    last_bgp_cpu = next(bgp_sampler)
+    last_ipfib_cpu = next(ipfib_sampler)
+    last_urib_cpu = next(urib_sampler)
 
     # get number of CPUs to define columns dynamically
     num_cpus = len(last_cpu)
     cpu_columns = [f"cpu{i+1}" for i in range(num_cpus)]  # e.g., cpu1, cpu2, ..., cpuX
     headers = ["rid", "router_name", "timestamp", "cpu"] + cpu_columns + ["bgp_cpu", "ipfib_cpu", "urib_cpu"]
 
-    while read_control(control_file) == 1:
-        # collect data
-        timestamp = datetime.utcnow().timestamp()
-        system_cpu_percent = psutil.cpu_percent(percpu=True)
-        bgp_process_cpu_percent = bgp_process.cpu_percent()
-        ipfib_process_cpu_percent = ipfib_process.cpu_percent()
-        urib_process_cpu_percent = urib_process.cpu_percent()
-
-        total_cpu_percent = sum(system_cpu_percent)
-
-        # store data
-        data_log.append(
-            (
-                router_id,
-                router_name,
-                timestamp,
-                total_cpu_percent,
-                *system_cpu_percent,
-                bgp_process_cpu_percent,
-                ipfib_process_cpu_percent,
-                urib_process_cpu_percent,
-            )
-        )
+    # all columns are numeric (apart from the router name), so format the rows directly instead of
+    # going through the csv writer
+    row_format = "%d,%s,%.6f,%.3f" + ",%.3f" * num_cpus + ",%.3f,%.3f,%.3f\n"
 
-        # sleep for the specified interval
-        time.sleep(interval)
+    file = open_log(output_file)
+    file.write(",".join(headers) + "\n")
+    # write the samples in batches to amortize the per-call overhead
+    batch = []
 
-    if output_file:
-        # Write the collected data to a CSV file
-        os.makedirs(os.path.dirname(output_file), exist_ok=True)
-        with open(output_file, mode="w", newline="") as file:
-            writer = csv.writer(file)
-            writer.writerow(headers)
-            for entry in data_log:
-                writer.writerow(entry)
-    else:
-        print(",".join(headers))
-        for entry in data_log:
-            print(",".join([str(x) for x in entry]))
+    # The sampling loop only allocates rows and lists of floats, none of which can form reference
+    # cycles. Disable the garbage collector while sampling, and move everything allocated so far
+    # into the permanent generation.
+    gc.freeze()
+    gc.disable()
+
+    # bind everything used in the sampling loop to locals, avoiding global and attribute lookups
+    now = time.time
+    monotonic = time.monotonic
+    wait = wait_for_next_sample
+    sample_cpu = cpu_sampler.__next__
+    sample_bgp = bgp_sampler.__next__
+    sample_ipfib = ipfib_sampler.__next__
+    sample_urib = urib_sampler.__next__
+    store = batch.append
+
+    try:
+        next_sample = monotonic()
+        while read_control(control_file) == 1:
+            # collect data
+            timestamp = now()
+            system_cpu_percent = sample_cpu()
+            bgp_process_cpu_percent = sample_bgp()
+            ipfib_process_cpu_percent = sample_ipfib()
+            urib_process_cpu_percent = sample_urib()
+
+            total_cpu_percent = sum(system_cpu_percent)
+
+            # store data
+            store(
+                (
+                    router_id,
+                    router_name,
+                    timestamp,
+                    total_cpu_percent,
+                    *system_cpu_percent,
+                    bgp_process_cpu_percent,
+                    ipfib_process_cpu_percent,
+                    urib_process_cpu_percent,
+                )
+            )
+            if len(batch) >= 256:
+                file.writelines([row_format % row for row in batch])
+                batch.clear()
+
+            next_sample = wait(next_sample, interval)
+    finally:
+        # write the remaining samples and re-enable the collector, also if the sampling failed
+        # (e.g., when a monitored process exited)
+        file.writelines([row_format % row for row in batch])
+        close_log(file)
+        gc.enable()
+        gc.unfreeze()
 
 
 def main():
@@ -1,5 +1,13 @@
+from contextlib import contextmanager
+from functools import lru_cache
 from netaddr import IPAddress, EUI
 
+# The rules below (mostly generated from the lab configuration) construct the same MAC and IP
+# addresses over and over again. Cache the constructors such that every distinct address string is
+# only parsed once.
+EUI = lru_cache(maxsize=None)(EUI)
+IPAddress = lru_cache(maxsize=None)(IPAddress)
+
 ##############################################################################################
 ################################## Populating Table Entries ##################################
 ##############################################################################################
@@ -184,6 +192,16 @@ p4 = bfrt.simple_router.pipe
 Ingress = p4.Ingress
 Egress = p4.Egress
 
+@contextmanager
+def batch():
+    """Send all table operations within this block to the switch as a single batch, instead of
+    waiting for a separate round-trip for each entry."""
+    bfrt.batch_begin()
+    try:
+        yield
+    finally:
+        bfrt.batch_end()
+
 # setting up multicast group to enable ARP
 bfrt.pre.node.entry(
     MULTICAST_NODE_ID=0x01, # BROADCAST_MGID
@@ -212,114 +230,103 @@ bfrt.pre.mgid.entry(
 # fill Ingress table(s)
 Ingress.delay.clear()
 if use_delayer:
-    for key in rules_delay:
-        Ingress.delay.add_with_send_delayed(key, **rules_delay[key])
+    with batch():
+        for key in rules_delay:
+            Ingress.delay.add_with_send_delayed(key, **rules_delay[key])
 
 Ingress.static_route.clear()
-for key in rules_static_route:
-    Ingress.static_route.add_with_send(key, **rules_static_route[key])
-# replicate data-plane traffic
-Ingress.static_route.add_with_replicate_traffic_client(ingress_port=traffic_replication_client_port)
-Ingress.static_route.add_with_send(ingress_port=traffic_replication_server_port, port=traffic_replication_client_port)
-if rules_mirror_all:
-    Ingress.static_route.add_with_drop(ingress_port=rules_mirror_all['mirror_port'])
+with batch():
+    for key in rules_static_route:
+        Ingress.static_route.add_with_send(key, **rules_static_route[key])
+    # replicate data-plane traffic
+    Ingress.static_route.add_with_replicate_traffic_client(ingress_port=traffic_replication_client_port)
+    Ingress.static_route.add_with_send(ingress_port=traffic_replication_server_port, port=traffic_replication_client_port)
+    if rules_mirror_all:
+        Ingress.static_route.add_with_drop(ingress_port=rules_mirror_all['mirror_port'])
 
 Ingress.ipv4_filter.clear()
-for key in rules_ipv4_filter:
-    Ingress.ipv4_filter.add_with_drop(key)
-# drop replicated data-plane traffic returning back to the Tofino
-Ingress.ipv4_filter.add_with_drop(IPAddress(traffic_replication_filter_src_ip))
+with batch():
+    for key in rules_ipv4_filter:
+        Ingress.ipv4_filter.add_with_drop(key)
+    # drop replicated data-plane traffic returning back to the Tofino
+    Ingress.ipv4_filter.add_with_drop(IPAddress(traffic_replication_filter_src_ip))
 
 Ingress.ipv4_route.clear()
-for key in rules_ipv4_route:
-    Ingress.ipv4_route.add_with_send(key, **rules_ipv4_route[key])
+with batch():
+    for key in rules_ipv4_route:
+        Ingress.ipv4_route.add_with_send(key, **rules_ipv4_route[key])
 
 Ingress.l2_route.clear()
-for key in rules_l2_route:
-    Ingress.l2_route.add_with_send(key, **rules_l2_route[key])
-Ingress.l2_route.add_with_broadcast(dst_addr=EUI("ff:ff:ff:ff:ff:ff"))
+with batch():
+    for key in rules_l2_route:
+        Ingress.l2_route.add_with_send(key, **rules_l2_route[key])
+    Ingress.l2_route.add_with_broadcast(dst_addr=EUI("ff:ff:ff:ff:ff:ff"))
 
 Ingress.fallback_route.clear()
-for key in rules_fallback_route:
-    Ingress.fallback_route.add_with_send(key, **rules_fallback_route[key])
+with batch():
+    for key in rules_fallback_route:
+        Ingress.fallback_route.add_with_send(key, **rules_fallback_route[key])
 if debug_port:
     Ingress.fallback_route.set_default_with_send(debug_port)
 
-Ingress.tcp_src_mirror.clear()
-Ingress.tcp_dst_mirror.clear()
-for key in rules_tcp_mirror:
-    mirror_session = rules_tcp_mirror[key]['mirror_session']
+# setup each mirror session only once, even if it is shared by many mirror rules (the last rule
+# referencing a session determines its mirror_port)
+mirror_sessions = {}
+for rules in (rules_tcp_mirror, rules_ip_mirror, rules_l2_mirror):
+    for rule in rules.values():
+        mirror_sessions[rule['mirror_session']] = rule['mirror_port']
+if rules_mirror_all:
+    mirror_sessions[rules_mirror_all['mirror_session']] = rules_mirror_all['mirror_port']
+for mirror_session, mirror_port in mirror_sessions.items():
     try:
         bfrt.mirror.cfg.delete(mirror_session)
     except BfRtTableError:
         pass # probably no entry exists
-    # setup mirror session to mirror TCP packets matching port to the mirror_port specified
+    # setup mirror session to mirror packets to the mirror_port specified
     bfrt.mirror.cfg.add_with_normal(
         sid=mirror_session, session_enable=True, direction='BOTH',
-        ucast_egress_port=rules_tcp_mirror[key]['mirror_port'], ucast_egress_port_valid=True,
+        ucast_egress_port=mirror_port, ucast_egress_port_valid=True,
         max_pkt_len=16384)
-    # fill Ingress table
-    Ingress.tcp_src_mirror.add_with_do_tcp_mirror(key, mirror_session=mirror_session)
-    Ingress.tcp_dst_mirror.add_with_do_tcp_mirror(key, mirror_session=mirror_session)
+
+Ingress.tcp_src_mirror.clear()
+Ingress.tcp_dst_mirror.clear()
+with batch():
+    for key in rules_tcp_mirror:
+        mirror_session = rules_tcp_mirror[key]['mirror_session']
+        Ingress.tcp_src_mirror.add_with_do_tcp_mirror(key, mirror_session=mirror_session)
+        Ingress.tcp_dst_mirror.add_with_do_tcp_mirror(key, mirror_session=mirror_session)
 
 Ingress.ip_mirror.clear()
-for key in rules_ip_mirror:
-    mirror_session = rules_ip_mirror[key]['mirror_session']
-    try:
-        bfrt.mirror.cfg.delete(mirror_session)
-    except BfRtTableError:
-        pass # probably no entry exists
-    # setup mirror session to mirror TCP packets matching port to the mirror_port specified
-    bfrt.mirror.cfg.add_with_normal(
-        sid=mirror_session, session_enable=True, direction='BOTH',
-        ucast_egress_port=rules_ip_mirror[key]['mirror_port'], ucast_egress_port_valid=True,
-        max_pkt_len=16384)
-    # fill Ingress table
-    Ingress.ip_mirror.add_with_do_ip_mirror(*key, mirror_session=mirror_session)
+with batch():
+    for key in rules_ip_mirror:
+        mirror_session = rules_ip_mirror[key]['mirror_session']
+        Ingress.ip_mirror.add_with_do_ip_mirror(*key, mirror_session=mirror_session)
 
 Ingress.l2_mirror.clear()
-for key in rules_l2_mirror:
-    mirror_session = rules_l2_mirror[key]['mirror_session']
-    try:
-        bfrt.mirror.cfg.delete(mirror_session)
-    except BfRtTableError:
-        pass # probably no entry exists
-    # setup mirror session to mirror TCP packets matching port to the mirror_port specified
-    bfrt.mirror.cfg.add_with_normal(
-        sid=mirror_session, session_enable=True, direction='BOTH',
-        ucast_egress_port=rules_l2_mirror[key]['mirror_port'], ucast_egress_port_valid=True,
-        max_pkt_len=16384)
-    # fill Ingress table
-    Ingress.l2_mirror.add_with_do_l2_mirror(*key, mirror_session=mirror_session)
+with batch():
+    for key in rules_l2_mirror:
+        mirror_session = rules_l2_mirror[key]['mirror_session']
+        Ingress.l2_mirror.add_with_do_l2_mirror(*key, mirror_session=mirror_session)
 
 Ingress.mirror_all.clear()
 if rules_mirror_all:
-    mirror_session = rules_mirror_all['mirror_session']
-    try:
-        bfrt.mirror.cfg.delete(mirror_session)
-    except BfRtTableError:
-        pass # probably no entry exists
-    # setup mirror session to mirror TCP packets matching port to the mirror_port specified
-    bfrt.mirror.cfg.add_with_normal(
-        sid=mirror_session, session_enable=True, direction='BOTH',
-        ucast_egress_port=rules_mirror_all['mirror_port'], ucast_egress_port_valid=True,
-        max_pkt_len=16384)
-    # fill Ingress table
-    Ingress.mirror_all.set_default_with_do_mirror_all(mirror_session=mirror_session)
+    Ingress.mirror_all.set_default_with_do_mirror_all(mirror_session=rules_mirror_all['mirror_session'])
 
 # fill Egress table(s)
 Egress.static_host_for_multicast_traffic.clear()
-for key in rules_traffic_replication:
-    # add rules for TRAFFIC_REPLICATION_MGID_CLIENT
-    Egress.static_host_for_multicast_traffic.add_with_set_l2_and_l3_src_and_dst_addr(0xFFFE, key, src_mac=EUI("de:ad:be:ef:de:ad"), src_ip=IPAddress(traffic_replication_filter_src_ip), **rules_traffic_replication[key])
-    # no rewrite required for client/server, as they are basically connected directly with a static route
+with batch():
+    for key in rules_traffic_replication:
+        # add rules for TRAFFIC_REPLICATION_MGID_CLIENT
+        Egress.static_host_for_multicast_traffic.add_with_set_l2_and_l3_src_and_dst_addr(0xFFFE, key, src_mac=EUI("de:ad:be:ef:de:ad"), src_ip=IPAddress(traffic_replication_filter_src_ip), **rules_traffic_replication[key])
+        # no rewrite required for client/server, as they are basically connected directly with a static route
 
 Egress.ipv4_host.clear()
-for key in rules_ipv4_host_src_mac:
-    Egress.ipv4_host.add_with_set_l2_src_addr(key, **rules_ipv4_host_src_mac[key])
-for key in rules_ipv4_host_dst_mac:
-    Egress.ipv4_host.add_with_set_l2_dst_addr(key, **rules_ipv4_host_dst_mac[key])
-for key in rules_ipv4_host_src_and_dst_mac:
-    Egress.ipv4_host.add_with_set_l2_src_and_dst_addr(key, **rules_ipv4_host_src_and_dst_mac[key])
+with batch():
+    for key in rules_ipv4_host_src_mac:
+        Egress.ipv4_host.add_with_set_l2_src_addr(key, **rules_ipv4_host_src_mac[key])
+    for key in rules_ipv4_host_dst_mac:
+        Egress.ipv4_host.add_with_set_l2_dst_addr(key, **rules_ipv4_host_dst_mac[key])
+    for key in rules_ipv4_host_src_and_dst_mac:
+        Egress.ipv4_host.add_with_set_l2_src_and_dst_addr(key, **rules_ipv4_host_src_and_dst_mac[key])
 
 bfrt.complete_operations()
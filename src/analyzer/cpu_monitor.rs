@@ -114,9 +114,10 @@ pub async fn setup_extended_cpu_monitoring<Q, Ospf: OspfImpl, S>(
         let mut output_path = output_dir.to_path_buf();
         output_path.push(format!("{}.csv", rid.fmt(net)));
 
+        // the interval is the period between two snapshots of all processes
         let child = session
             .command(format!(
-                "run bash python3 {CPU_MONITOR_FILE} --control-file {CPU_MONITOR_CONTROL_FILE} --interval 0.001 --std-out --router-id {} --router-name {} --all-processes",
+                "run bash python3 {CPU_MONITOR_FILE} --control-file {CPU_MONITOR_CONTROL_FILE} --interval 0.1 --std-out --router-id {} --router-name {} --all-processes",
                 rid.index(),
                 rid.fmt(net),
             ))
@@ -18,11 +18,22 @@
 
 import argparse
 import glob
+import hashlib
 import os
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import sys
 import re
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pa_parquet
+except ImportError:
+    # pyarrow is optional, fall back to the CSV parser of pandas
+    pa = None
 
 plot_list = ["err", "abs_err", "rel_err", "rel_total_err", "violation", "raw", "quantiles"]
 
@@ -89,7 +100,7 @@ plot_list = {p for p in plot_list if p not in args.exclude_plot}
 
 # collect data into a single dataframe
 eval_files = list(glob.glob(args.eval_path + "/**/eval_*.csv"))
-dfs = []
+files = []
 for f in eval_files:
     # ensure skip file is not present
     if os.path.exists(f.replace(".csv", ".skip")):
@@ -101,19 +112,124 @@ for f in eval_files:
         continue
     if "_Prefix" not in f:
         continue
-    # try to read data from csv
-    print(f"reading {f}")
+    files.append(f)
+
+# the combined data is kept as a pyarrow table (or a pandas frame without pyarrow) until it is
+# sampled, such that only the sampled rows are converted to pandas. It is cached as parquet, keyed
+# on the selected files and their modification times. The most recently used caches are kept, such
+# that runs with different file selections on the same eval_path don't evict each other.
+max_caches = 8
+fingerprint = hashlib.sha1(repr(sorted((os.path.abspath(f), os.path.getmtime(f)) for f in files)).encode()).hexdigest()
+cache_file = os.path.join(args.eval_path, f".cache_{fingerprint}.parquet")
+
+data = None
+if os.path.exists(cache_file):
+    print(f"reading cached data from {cache_file}")
     try:
-        dfs.append(pd.read_csv(f, delimiter=";"))
+        data = pa_parquet.read_table(cache_file) if pa is not None else pd.read_parquet(cache_file)
+    except ImportError:
+        # neither pyarrow nor fastparquet is installed, read the csv files but keep the cache
+        print("cannot read the cache without pyarrow or fastparquet")
     except Exception as e:
+        # the cache is broken, rebuild it from the csv files
+        print(f"cannot read the cache ({e}), rebuilding it")
+        try:
+            os.remove(cache_file)
+        except OSError:
+            pass
+    else:
+        # mark the cache as recently used (unless the results directory is read-only)
+        try:
+            os.utime(cache_file)
+        except OSError:
+            pass
+
+if data is None:
+    if pa is not None:
+        # parse with the (multi-threaded) CSV reader of pyarrow, using the column types of the
+        # evaluation records (see `EvaluationRecord` in src/records.rs) instead of inferring them
+        parse_options = pa_csv.ParseOptions(delimiter=";")
+        convert_options = pa_csv.ConvertOptions(
+            column_types={
+                "model": pa.string(),
+                "sample_id": pa.string(),
+                "num_prefixes": pa.int64(),
+                "scenario": pa.string(),
+                "rid": pa.int64(),
+                "router": pa.string(),
+                "prefix": pa.string(),
+                **{c: pa.float64() for c in [
+                    "measured", "baseline", "computed",
+                    "err_baseline", "err", "rel_err_baseline", "rel_err", "abs_err_baseline", "abs_err",
+                    "rel_err_total_baseline", "rel_err_total",
+                ]},
+            },
+            # treat empty strings as missing, like pandas does
+            strings_can_be_null=True,
+        )
+
+    def read_eval_file(f):
+        # try to read data from csv
+        print(f"reading {f}")
+        try:
+            if pa is not None:
+                return pa_csv.read_csv(f, parse_options=parse_options, convert_options=convert_options)
+            return pd.read_csv(f, delimiter=";", engine="c")
+        except Exception as e:
+            return None
+
+    # both parsers release the GIL while parsing, so read the files in parallel
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        dfs = [d for d in executor.map(read_eval_file, files) if d is not None]
+
+    # no data found, abort plotting
+    if len(dfs) == 0:
+        print("No usable data found.")
+        sys.exit(0)
+
+    # neither concatenation copies the data; files without some of the columns are filled with nulls
+    if pa is not None:
+        data = pa.concat_tables(dfs, promote_options="default")
+    else:
+        data = pd.concat(dfs, copy=False, ignore_index=True, sort=False)
+
+    # write the cache to a temporary file first, such that an interrupted run cannot leave a
+    # truncated cache behind
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    try:
+        if pa is not None:
+            pa_parquet.write_table(data, tmp_file)
+        else:
+            data.to_parquet(tmp_file)
+        os.replace(tmp_file, cache_file)
+        # evict the least recently used caches
+        caches = sorted(glob.glob(os.path.join(args.eval_path, ".cache_*.parquet")), key=os.path.getmtime, reverse=True)
+        for f in caches[max_caches:]:
+            os.remove(f)
+    except (ImportError, OSError):
+        # neither pyarrow nor fastparquet is installed or the results directory is not writable,
+        # don't cache the data
         pass
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
 
-# no data found, abort plotting
-if len(dfs) == 0:
-    print("No usable data found.")
-    sys.exit(0)
+if not (len(plot_list) == 1 and "quantiles" in plot_list) or args.sample:
+    target_samples = args.sample if args.sample else 100000
+    # pick the samples directly from the (positional) indices of the rows to consider
+    rows = np.arange(len(data))
+    if args.only_nonzero:
+        rows = np.flatnonzero(np.asarray(data["measured"]) > 0.0)
+    n_samples = min(len(rows), target_samples)
+    print(f"sampling... ({n_samples} of {len(rows)})")
+    # the order of the samples does not matter, so skip the final shuffle of the generator
+    data = data.take(np.random.default_rng().choice(rows, size=n_samples, replace=False, shuffle=False))
 
-df = pd.concat(dfs)
+df = data.to_pandas() if pa is not None else data
+
+# the model and scenario columns only contain a few distinct strings, store them as categoricals
+for c in ["model", "scenario"]:
+    df[c] = df[c].astype("category")
 
 # filter by sample_id
 filtered_df = df[df["sample_id"].str.contains(args.filter_sample_id, na=False)]
@@ -130,50 +246,71 @@ df.rename(columns={
     'measured': 'violation_ground_truth',
 }, inplace=True)
 
-if not (len(plot_list) == 1 and "quantiles" in plot_list) or args.sample:
-    target_samples = args.sample if args.sample else 100000
-    n_samples = min(len(df), target_samples)
-    print(f"sampling... ({n_samples} of {len(df)})")
-    if args.only_nonzero:
-        df = df[df["violation_ground_truth"] > 0.0]
-    df = df.sample(n_samples)
+stubnames = ["err", "rel_err", "abs_err", "rel_total_err", "violation"]
+# split the value columns into (stub, source), e.g., "rel_err_baseline" -> ("rel_err", "baseline")
+value_cols = {c: (stub, c[len(stub) + 1:]) for c in df.columns for stub in stubnames if c.startswith(stub + "_")}
+
+# drop the value columns not required for the requested plots before reshaping. All stubs are
+# shown in the hover data of the CDF and raw plots, while the quantiles (and the printed statistics)
+# only need the absolute error. The rows for --only-nonzero are already picked while sampling.
+needed_stubs = set(stubnames) if plot_list - {"quantiles"} else {"abs_err"}
+value_cols = {c: (stub, source) for c, (stub, source) in value_cols.items() if stub in needed_stubs}
+df = df[[c for c in df.columns if c in value_cols or not c.startswith(tuple(s + "_" for s in stubnames))]]
 
 print("filtering the model...")
 if args.include_model:
     df = df[df["model"].isin(args.include_model)]
 if args.exclude_model:
-    for model in args.exclude_model:
-        df = df[df["model"].map(lambda m: model not in m)]
+    models = df["model"].cat.categories
+    excluded = models[models.str.contains("|".join(map(re.escape, args.exclude_model)), regex=True)]
+    df = df[~df["model"].isin(excluded)]
+df["model"] = df["model"].cat.remove_unused_categories()
 
 # print statistics
-models = set(df["model"])
+models = set(df["model"].cat.categories)
+# compare each model to the shortest model whose name (without the ".csv" suffix) is part of its name
+no_models = {model: min((m for m in models if m[:-4] in model), key=lambda x: len(x)) for model in models}
+mean_err = df.groupby("model", observed=True)[["abs_err_baseline", "abs_err_alg"]].mean()
 for model in models:
-    dfm = df[df["model"] == model]
     if model == "fw_updates":
-        mean_baseline_err = dfm["abs_err_baseline"].mean()
-        mean_alg_err = dfm["abs_err_alg"].mean()
+        mean_baseline_err = mean_err.at[model, "abs_err_baseline"]
+        mean_alg_err = mean_err.at[model, "abs_err_alg"]
         print("Model", model)
         print("  Compare to the baseline algorithm")
         print("    mean baseline error:", mean_baseline_err)
         print("    mean algorithm error:", mean_alg_err)
         print("    algorithm improvement (in mean):", (mean_baseline_err - mean_alg_err) / mean_baseline_err)
 
-    no_model = min((m for m in models if m[:-4] in model), key=lambda x: len(x))
+    no_model = no_models[model]
     if no_model != model:
-        dfnm = df[df["model"] == no_model]
         print("Model", model)
         print("  Compare to", no_model)
-        mean_naive_err = dfnm["abs_err_alg"].mean()
-        mean_fib_queue_err = dfm["abs_err_alg"].mean()
+        mean_naive_err = mean_err.at[no_model, "abs_err_alg"]
+        mean_fib_queue_err = mean_err.at[model, "abs_err_alg"]
         print("    mean naive error:", mean_naive_err)
         print("    mean FIB queue error:", mean_fib_queue_err)
         print("    FIB queue improvement (in mean):", (mean_naive_err - mean_fib_queue_err) / mean_naive_err)
 
 
 print("transforming...")
-# add "source" column, transofrm to long
+# generate ID column (only shown in the raw plot). It is the same for all sources of a measurement,
+# so build it before transforming to long instead of once per source.
 id_cols = ["sample_id", "model", "scenario", "num_prefixes", "rid", "prefix"]
-df_all = pd.wide_to_long(df, stubnames=["err", "rel_err", "abs_err", "rel_total_err", "violation"], i=id_cols, sep="_", j="source", suffix='\\w+').reset_index()
+if "raw" in plot_list:
+    id_parts = [df[c].astype(str) for c in id_cols if c not in {"scenario", "model"}]
+    df["id"] = id_parts[0].str.cat(id_parts[1:], sep=", ")
+
+# add "source" column, transofrm to long
+other_cols = [c for c in df.columns if c not in value_cols]
+# stack the value columns of each source below each other (much faster than pd.wide_to_long)
+parts = []
+for source in dict.fromkeys(source for _, source in value_cols.values()):
+    renames = {c: stub for c, (stub, s) in value_cols.items() if s == source}
+    part = df[other_cols + list(renames)].rename(columns=renames)
+    part.insert(len(other_cols), "source", source)
+    parts.append(part)
+df_all = pd.concat(parts, ignore_index=True)
+df_all["source"] = df_all["source"].astype("category")
 
 # filter models
 print("filtering the algorithm...")
@@ -182,84 +319,95 @@ if args.include_algorithm:
 if args.exclude_algorithm:
     for algorithm in args.exclude_algorithm:
         df_all = df_all[df_all["source"] != algorithm]
-
-# generate ID column
-df_all["id"] = df_all.apply(lambda row: ", ".join((str(row[c]) for c in id_cols if c not in {"scenario", "model"})), axis=1)
+df_all["source"] = df_all["source"].cat.remove_unused_categories()
 
 if "raw" in plot_list:
     print("sorting...")
-    df_all.sort_values("violation", inplace=True)
-    df_all.sort_values("source", inplace=True)
-    df_all.sort_values("model", inplace=True)
+    df_all.sort_values(["model", "source", "violation"], inplace=True)
 
-df = df_all[df_all["source"] != "ground_truth"]
+# the ground truth is only part of the long format if its violation times are needed (not for the quantiles)
+if "ground_truth" in df_all["source"].cat.categories:
+    df = df_all[df_all["source"] != "ground_truth"]
+else:
+    df = df_all
 
 hover_data = ["sample_id", "model", "scenario", "num_prefixes", "router", "prefix", "err", "abs_err", "rel_err", "rel_total_err", "violation"]
 
+# empirical CDF of `col` for each model and source, keeping the given extra columns of the sampled rows
+def error_cdf(df, col, columns=[], keep_max=False):
+    df = df[list(dict.fromkeys(["model", "source", col] + columns))].sort_values(["model", "source", col], ignore_index=True)
+    groups = df.groupby(["model", "source"], observed=True)
+    rank = groups.cumcount()
+    size = groups[col].transform("size")
+    df["cdf"] = rank / size
+    # sample equidistant points to make plotting sufficiently fast
+    keep = rank % (size // 1000).clip(lower=1) == 0
+    if keep_max:
+        # also keep the largest value and count each value itself (like px.ecdf), such that the
+        # plotted CDF covers the whole range and reaches 1
+        keep |= rank == size - 1
+        df["cdf"] = (rank + 1) / size
+    return df[keep].reset_index(drop=True)
+
+# write the rows of every included model to `<prefix>_<model>.csv`
+def write_model_csvs(df, prefix):
+    models = dict(list(df.groupby("model", observed=True)))
+    for model in args.include_model:
+        models.get(model, df.iloc[:0]).to_csv(os.path.join(args.eval_path, f"{prefix}_{model}.csv"), index=False)
+
 if "err" in plot_list:
     print("Creating eval.html")
     # create the CDF plots
     # Signed error, ground_truth - computed, to allow deducing which value is typically larger.
-    fig = px.ecdf(
-        df,
+    cdf = error_cdf(df, "err", hover_data, keep_max=True)
+    fig = px.line(
+        cdf,
         x="err",
+        y="cdf",
         color="model",
         line_dash="source",
+        line_shape="hv",
         hover_data=hover_data,
         labels={"err": "(Signed) Error", "cdf": "CDF", "source": "Algorithm"},
         title="CDF of (signed) error, (ground_truth - computed), by input source / algorithm used"
     )
     if args.show:
         fig.show()
-    fig.write_html(args.eval_path + "/eval.html")
+    fig.write_html(args.eval_path + "/eval.html", include_plotlyjs="cdn", include_mathjax=False)
 
 if "rel_err" in plot_list:
     filename = os.path.join(args.eval_path, "eval_rel.html")
     print(f"Creating {filename}")
-    fig_rel = px.ecdf(
-        df,
+    cdf = error_cdf(df, "rel_err", hover_data, keep_max=True)
+    fig_rel = px.line(
+        cdf,
         x="rel_err",
+        y="cdf",
         color="model",
         line_dash="source",
+        line_shape="hv",
         hover_data=hover_data,
         labels={"rel_err": "Relative Error", "cdf": "CDF", "source": "Algorithm"},
         title="CDF of relative error by input source / algorithm used"
     )
     if args.show:
         fig_rel.show()
-    fig_rel.write_html(filename)
+    fig_rel.write_html(filename, include_plotlyjs="cdn", include_mathjax=False)
 
-    def rel_err_cdf(df):
-        df = df.sort_values(["rel_err"]).reset_index()[["model", "source", "rel_err"]]
-        df["cdf"] = df.index / len(df)
-        # sample equidistant points to make plotting sufficiently fast
-        df = df[df.index % (len(df) // 1000) == 0]
-        return df
-
-    cdf = df.groupby(["model", "source"]).apply(rel_err_cdf).reset_index(drop=True)
-    cdf.sort_values(["model", "source", "cdf"], inplace=True)
-
-    for model in args.include_model:
-        cdf[cdf["model"] == model].to_csv(os.path.join(args.eval_path, f"rel_error_{model}.csv"), index=False)
+    write_model_csvs(error_cdf(df, "rel_err"), "rel_error")
 
     filename = os.path.join(args.eval_path, "eval_rel_vs_violation.html")
     print(f"Creating {filename}")
     # print the violation in these groups
     def violation_bins(df):
-        def violation_mean(x):
-            return x.mean()
-        def violation_q50(x):
-            return x.quantile(0.5)
-        def violation_q75(x):
-            return x.quantile(0.75)
-        def violation_q90(x):
-            return x.quantile(0.9)
-        df = df.sort_values("rel_err").reset_index()
-        del df["index"]
-        df["cdf"] = (df.index * 50 / len(df)).astype(int) / 50.0 + 0.01
-        df = df.groupby("cdf")["violation"].aggregate([violation_mean, violation_q50, violation_q75, violation_q90]).reset_index()
-        return pd.wide_to_long(df, stubnames="violation", i="cdf", j="aggregate", suffix="\\w+", sep="_")
-    violation = df.groupby(["model", "source"]).apply(violation_bins).reset_index()
+        df = df[["model", "source", "rel_err", "violation"]].sort_values(["model", "source", "rel_err"], ignore_index=True)
+        groups = df.groupby(["model", "source"], observed=True)
+        df["cdf"] = (groups.cumcount() * 50 / groups["rel_err"].transform("size")).astype(int) / 50.0 + 0.01
+        bins = df.groupby(["model", "source", "cdf"], observed=True)["violation"]
+        df = pd.DataFrame({"mean": bins.mean(), "q50": bins.quantile(0.5), "q75": bins.quantile(0.75), "q90": bins.quantile(0.9)})
+        df.columns.name = "aggregate"
+        return df.stack().rename("violation").reset_index()
+    violation = violation_bins(df)
     violation["model, source"] = violation["model"].astype(str) + ", " + violation["source"].astype(str)
     fig_rel = px.line(
         violation,
@@ -271,7 +419,7 @@ if "rel_err" in plot_list:
     )
     if args.show:
         fig_rel.show()
-    fig_rel.write_html(filename)
+    fig_rel.write_html(filename, include_plotlyjs="cdn", include_mathjax=False)
 
 
 
@@ -283,77 +431,64 @@ if "rel_err" in plot_list:
 if "rel_total_err" in plot_list:
     filename = os.path.join(args.eval_path, "eval_rel_total.html")
     print(f"Creating {filename}")
-    fig_rel_total = px.ecdf(
-        df,
+    cdf = error_cdf(df, "rel_total_err", hover_data, keep_max=True)
+    fig_rel_total = px.line(
+        cdf,
         x="rel_total_err",
+        y="cdf",
         color="model",
         line_dash="source",
+        line_shape="hv",
         hover_data=hover_data,
         labels={"rel_err_total": "Relative Error", "cdf": "CDF", "source": "Algorithm"},
         title="CDF of total relative error (w.r.t. total convergence time) by input source / algorithm used"
     )
     if args.show:
         fig_rel_total.show()
-    fig_rel_total.write_html(filename)
+    fig_rel_total.write_html(filename, include_plotlyjs="cdn", include_mathjax=False)
 
-    def rel_total_err_cdf(df):
-        df = df.sort_values(["rel_total_err"]).reset_index()[["model", "source", "rel_total_err"]]
-        df["cdf"] = df.index / len(df)
-        # sample equidistant points to make plotting sufficiently fast
-        df = df[df.index % (len(df) // 1000) == 0]
-        return df
-
-    cdf = df.groupby(["model", "source"]).apply(rel_total_err_cdf).reset_index(drop=True)
-    cdf.sort_values(["model", "source", "cdf"], inplace=True)
-
-    for model in args.include_model:
-        cdf[cdf["model"] == model].to_csv(os.path.join(args.eval_path, f"rel_total_err_{model}.csv"), index=False)
+    write_model_csvs(error_cdf(df, "rel_total_err"), "rel_total_err")
 
 if "abs_err" in plot_list:
     filename = os.path.join(args.eval_path, "eval_abs.html")
     print(f"Creating {filename}")
-    fig_abs = px.ecdf(
-        df,
+    cdf = error_cdf(df, "abs_err", hover_data, keep_max=True)
+    fig_abs = px.line(
+        cdf,
         x="abs_err",
+        y="cdf",
         color="model",
         line_dash="source",
+        line_shape="hv",
         hover_data=hover_data,
         labels={"abs_err": "Absolute Error", "cdf": "CDF", "source": "Algorithm"},
         title="CDF of absolute error by input source / algorithm used"
     )
     if args.show:
         fig_abs.show()
-    fig_abs.write_html(filename)
-
-    def abs_err_cdf(df):
-        df = df.sort_values(["abs_err"]).reset_index()[["model", "source", "abs_err"]]
-        df["cdf"] = df.index / len(df)
-        # sample equidistant points to make plotting sufficiently fast
-        df = df[df.index % (len(df) // 1000) == 0]
-        return df
-
-    cdf = df.groupby(["model", "source"]).apply(abs_err_cdf).reset_index(drop=True)
-    cdf.sort_values(["model", "source", "cdf"], inplace=True)
+    fig_abs.write_html(filename, include_plotlyjs="cdn", include_mathjax=False)
 
-    for model in args.include_model:
-        cdf[cdf["model"] == model].to_csv(os.path.join(args.eval_path, f"abs_error_{model}.csv"), index=False)
+    write_model_csvs(error_cdf(df, "abs_err"), "abs_error")
 
 # Plot the violation times as CDFs to illustrate whether the distributions are similar.
 if "violation" in plot_list:
     filename = os.path.join(args.eval_path, "eval_total.html")
     print(f"Creating {filename}")
-    fig_total = px.ecdf(
-        df_all,
+    cdf = error_cdf(df_all, "violation", hover_data, keep_max=True)
+    fig_total = px.line(
+        cdf,
         x="violation",
+        y="cdf",
         color="model",
         line_dash="source",
+        line_shape="hv",
         hover_data=hover_data,
         labels={"violation": "Total Violation Time", "cdf": "CDF", "source": "Algorithm"},
         title="CDF of total violation by input source / algorithm used"
     )
     if args.show:
         fig_total.show()
-    fig_total.write_html(filename)
+    fig_total.write_html(filename, include_plotlyjs="cdn", include_mathjax=False)
 
 # Plot the raw data, each line on the y axis corresponding to one EvaluationRecord.
 # Ideally, shapes should be similar / follow the ground truth.
@@ -367,18 +502,20 @@ if "raw" in plot_list:
         color="model",
         hover_data=hover_data,
         labels={"violation": "Total Violation Time", "id": "Measurement Identifier (sample_id, model, scenario, rid, prefix)"},
-        title="Raw violation by input source / algorithm used"
+        title="Raw violation by input source / algorithm used",
+        render_mode="webgl",
     )
     if args.show:
         fig_raw.show()
-    fig_raw.write_html(filename)
+    fig_raw.write_html(filename, include_plotlyjs="cdn", include_mathjax=False)
 
 if "quantiles" in plot_list:
     filename = os.path.join(args.eval_path, "eval_quantiles.html")
     print(f"Creating {filename}")
     percentiles = args.perc if args.perc else [0.5, 0.75, 0.8, 0.9, 0.95, 0.99]
     percentiles = [float(p) for p in percentiles]
-    quantiles = df.groupby(["model", "source", "num_prefixes"]).quantile(percentiles).reset_index().rename(columns = {"level_3": "quantile"})
+    by_prefixes = df.groupby(["model", "source", "num_prefixes"], observed=True)["abs_err"]
+    quantiles = by_prefixes.quantile(percentiles).reset_index().rename(columns = {"level_3": "quantile"})
 
     quantiles["model_source"] = quantiles["model"].astype(str) + ", " + quantiles["source"].astype(str)
 
@@ -394,14 +531,11 @@ if "quantiles" in plot_list:
     )
     if args.show:
         fig_quantiles.show()
-    fig_quantiles.write_html(filename)
+    fig_quantiles.write_html(filename, include_plotlyjs="cdn", include_mathjax=False)
 
     # prepare csv
-    percentiles = args.perc if args.perc else [0.5, 0.75, 0.8, 0.9, 0.95, 0.99]
-    quantiles = df.groupby(["model", "source", "num_prefixes"])[["model", "source", "abs_err"]].quantile(percentiles).reset_index().rename(columns = {"level_3": "quantile"})
-    avg = df.groupby(["model", "source", "num_prefixes"])[["model", "source", "abs_err"]].mean()
+    avg = by_prefixes.mean().reset_index()
     avg["quantile"] = "avg"
-    avg.reset_index(inplace=True)
     quantiles = pd.concat([quantiles, avg], sort=True)
     quantiles["key"] = quantiles["model"].astype(str) + ":" + quantiles["source"].astype(str) + ":" + quantiles["quantile"].astype(str)
     quantiles = quantiles.pivot(columns="key", index="num_prefixes", values="abs_err")